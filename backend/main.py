@@ -4,31 +4,176 @@ Upload a PDF → Get structured summary + section analysis
 """
 
 import hashlib
+import os
+import tempfile
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timezone
 from threading import Lock
 
+import diskcache
 from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-
-from pdf_extractor import extract_text_by_pages, detect_sections
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+
+from pdf_extractor import (
+    extract_text_by_pages,
+    detect_sections,
+    skipped_page_numbers,
+    PDFTooLarge,
+)
+from semantic_cache import SemanticIndex, embed
 from summarizer import process_paper, count_tokens, RateLimitExceeded
 
 app = FastAPI(
     title="Stark Paper Analyzer",
     description="Upload research papers and get structured summaries",
     version="0.1.0",
+    default_response_class=ORJSONResponse,
 )
 
-JOBS: dict[str, dict] = {}
-ANALYSIS_CACHE: dict[str, dict] = {}
+
+class LRUCache:
+    """
+    Size-bounded store that evicts the least recently used entry and expires
+    entries past their TTL on read (`ttl_seconds` unless `set` is given one).
+    Not thread-safe by itself; callers hold STORE_LOCK.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # key -> (expires_at, value), oldest use first
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+    def get(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() >= entry[0]:
+            del self._entries[key]
+            entry = None
+
+        if entry is None:
+            return None
+
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def expires_in(self, key: str) -> float | None:
+        """Seconds until `key` expires, or None if it is not cached."""
+        entry = self._entries.get(key)
+        return None if entry is None else entry[0] - time.monotonic()
+
+    def set(self, key: str, value: dict, ttl_seconds: float | None = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+MAX_CACHE_ENTRIES = 32  # In-memory L1 for hot papers; the disk cache holds the rest
+CACHE_TTL_SECONDS = 24 * 60 * 60
+DISK_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".analysis_cache")
+DISK_CACHE_SIZE_LIMIT = 1 << 30  # 1 GiB
+JOB_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".jobs")
+JOB_STORE_SIZE_LIMIT = 256 * 1024 * 1024
+JOB_TTL_SECONDS = 60 * 60
+
+ANALYSIS_CACHE = LRUCache(MAX_CACHE_ENTRIES, CACHE_TTL_SECONDS)
+# Per-process and in memory only: rebuilt empty on restart, not shared between workers
+SEMANTIC_INDEX = SemanticIndex()
 STORE_LOCK = Lock()
+# Per-process lookup outcomes; a miss means the paper had to be analyzed from scratch
+CACHE_STATS = {"l1_hits": 0, "disk_hits": 0, "semantic_hits": 0, "misses": 0}
+
+# Persistent L2 so analyses survive restarts; diskcache does its own locking
+DISK_CACHE = diskcache.Cache(DISK_CACHE_DIR, size_limit=DISK_CACHE_SIZE_LIMIT)
+
+# Jobs live on disk too so any worker process can answer status/result requests
+JOBS = diskcache.Cache(JOB_STORE_DIR, size_limit=JOB_STORE_SIZE_LIMIT)
+
+UPLOAD_CHUNK_BYTES = 1 << 20  # Read uploads 1 MiB at a time
+UPLOAD_SPOOL_MAX_BYTES = 8 * 1024 * 1024  # Spill uploads larger than this to disk
+MAX_PDF_BYTES = 50 * 1024 * 1024
+MAX_REQUEST_BYTES = MAX_PDF_BYTES + (1 << 20)  # Allow for multipart framing around the file
+UPLOAD_TOO_LARGE_DETAIL = f"PDF exceeds the {MAX_PDF_BYTES // (1024 * 1024)} MB upload limit."
+
+
+class MaxBodySizeMiddleware:
+    """
+    Reject request bodies over `max_bytes` before the multipart form is parsed:
+    up front from Content-Length, and while streaming for requests without it.
+    Starlette spools the whole form before the endpoint runs, so checks in the
+    endpoint alone come too late to stop an oversized upload.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = ORJSONResponse(
+                status_code=413, content={"detail": UPLOAD_TOO_LARGE_DETAIL}
+            )
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Raised inside form parsing; FastAPI turns it into the 413 response
+                    raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_DETAIL)
+            return message
+
+        await self.app(scope, limited_receive, send)
 
 
 def _now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+async def _spool_upload(file: UploadFile) -> tuple[tempfile.SpooledTemporaryFile, str]:
+    """
+    Copy the upload into a spooled temp file in chunks instead of one big read.
+    The SHA-256 is computed in the same pass, so the bytes are only scanned once.
+    Rejects uploads over MAX_PDF_BYTES with a 413.
+    """
+    too_large = HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_DETAIL)
+    # file.size may be unknown, so the copy loop enforces the limit as well
+    if file.size is not None and file.size > MAX_PDF_BYTES:
+        raise too_large
+
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_BYTES)
+    h = hashlib.sha256()
+    total_bytes = 0
+    while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+        total_bytes += len(chunk)
+        if total_bytes > MAX_PDF_BYTES:
+            spool.close()
+            raise too_large
+        h.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+    return spool, h.hexdigest()
+
+
 def _build_fallback_analysis(sections: list[dict], reason: str) -> dict:
     fallback_sections = [
         {
@@ -64,29 +209,131 @@ def _build_fallback_analysis(sections: list[dict], reason: str) -> dict:
     }
 
 
-def _set_job(job_id: str, **updates):
+# The cache helpers below touch diskcache (SQLite + pickling of large payloads);
+# async callers run them through run_in_threadpool.
+
+
+def _count_cache_event(stat: str):
+    with STORE_LOCK:
+        CACHE_STATS[stat] += 1
+
+
+def _lookup_analysis(file_hash: str) -> tuple[dict | None, str | None, float]:
+    """
+    Look up an analysis in memory first, then on disk (promoting disk hits).
+    Returns the payload, the tier it came from ("l1" or "disk") and the
+    seconds the entry has left.
+    """
     with STORE_LOCK:
+        payload = ANALYSIS_CACHE.get(file_hash)
+        remaining = ANALYSIS_CACHE.expires_in(file_hash) if payload is not None else 0
+    if payload is not None:
+        return payload, "l1", remaining
+
+    payload, expire_time = DISK_CACHE.get(file_hash, expire_time=True)
+    if payload is not None:
+        # Keep the disk entry's remaining lifetime instead of starting a fresh TTL
+        remaining = CACHE_TTL_SECONDS if expire_time is None else expire_time - time.time()
+        if remaining > 0:
+            with STORE_LOCK:
+                ANALYSIS_CACHE.set(file_hash, payload, ttl_seconds=remaining)
+        return payload, "disk", remaining
+    return None, None, 0
+
+
+def _get_cached_analysis(file_hash: str) -> dict | None:
+    """Exact-hash lookup. Misses are counted by _get_similar_cached, the last tier."""
+    payload, tier, _ = _lookup_analysis(file_hash)
+    if payload is not None:
+        _count_cache_event(f"{tier}_hits")
+    return payload
+
+
+def _store_analysis(file_hash: str, payload: dict, fingerprint_vec=None, text_length: int = 0):
+    DISK_CACHE.set(file_hash, payload, expire=CACHE_TTL_SECONDS)
+    with STORE_LOCK:
+        ANALYSIS_CACHE.set(file_hash, payload)
+        SEMANTIC_INDEX.add(fingerprint_vec, file_hash, payload["total_pages"], text_length)
+
+
+def _get_similar_cached(
+    file_hash: str, fingerprint_vec, filename: str, pages: list[dict], full_text: str
+) -> dict | None:
+    """
+    Return a cached analysis for a near-duplicate paper, if one is still cached.
+    The per-upload fields are replaced with this upload's values, and the result
+    is stored under this upload's hash so a repeat upload is an exact hit.
+    """
+    with STORE_LOCK:
+        similar_hash = SEMANTIC_INDEX.search(fingerprint_vec, len(pages), len(full_text))
+    cached_payload, _, remaining = (
+        _lookup_analysis(similar_hash) if similar_hash else (None, None, 0)
+    )
+
+    if not cached_payload:
+        _count_cache_event("misses")
+        return None
+
+    _count_cache_event("semantic_hits")
+    payload = {
+        **cached_payload,
+        "filename": filename,
+        "total_pages": len(pages),
+        "total_tokens": count_tokens(full_text),
+    }
+    # Expire with the matched entry; the index already points at that one
+    if remaining > 0:
+        DISK_CACHE.set(file_hash, payload, expire=remaining)
+        with STORE_LOCK:
+            ANALYSIS_CACHE.set(file_hash, payload, ttl_seconds=remaining)
+    return payload
+
+
+def _update_job(job_id: str, updates: dict):
+    # transact() locks the store across processes for the read-modify-write
+    with JOBS.transact():
         job = JOBS.get(job_id)
         if not job:
             return
         job.update(updates)
+        JOBS.set(job_id, job, expire=JOB_TTL_SECONDS)
+
 
+async def _set_job(job_id: str, **updates):
+    # The transaction can wait on other worker processes; keep it off the event loop
+    await run_in_threadpool(_update_job, job_id, updates)
 
-def _run_analysis_job(job_id: str, filename: str, file_bytes: bytes, file_hash: str):
-    _set_job(job_id, status="running", started_at=_now_iso(), error=None)
+
+async def _run_analysis_job(
+    job_id: str, filename: str, spool: tempfile.SpooledTemporaryFile, file_hash: str
+):
+    await _set_job(job_id, status="running", started_at=_now_iso(), error=None)
 
     try:
-        pages = extract_text_by_pages(file_bytes)
+        cached_payload = await run_in_threadpool(_get_cached_analysis, file_hash)
+
+        if cached_payload:
+            await _set_job(
+                job_id,
+                status="completed",
+                completed_at=_now_iso(),
+                result={**cached_payload, "cached": True},
+            )
+            return
+
+        # Parsing is CPU-bound; keep it off the event loop
+        pages = await run_in_threadpool(extract_text_by_pages, spool.read())
         full_text = "\n\n".join(p["text"] for p in pages if p["text"])
 
         if not full_text.strip():
             raise ValueError("PDF contains no extractable text. It may be scanned/image-based.")
 
-        with STORE_LOCK:
-            cached_payload = ANALYSIS_CACHE.get(file_hash)
-
+        fingerprint_vec = await run_in_threadpool(embed, full_text)
+        cached_payload = await run_in_threadpool(
+            _get_similar_cached, file_hash, fingerprint_vec, filename, pages, full_text
+        )
         if cached_payload:
-            _set_job(
+            await _set_job(
                 job_id,
                 status="completed",
                 completed_at=_now_iso(),
@@ -94,25 +341,33 @@ def _run_analysis_job(job_id: str, filename: str, file_bytes: bytes, file_hash:
             )
             return
 
-        sections = detect_sections(pages)
+        sections = await run_in_threadpool(detect_sections, pages, full_text)
+        tokens = count_tokens(full_text)
+        skipped_pages = skipped_page_numbers(pages)
 
         try:
-            analysis = process_paper(sections)
+            analysis = await process_paper(sections)
             payload = {
                 "filename": filename,
                 "total_pages": len(pages),
-                "total_tokens": count_tokens(full_text),
+                "total_tokens": tokens,
+                "skipped_pages": skipped_pages,
                 "analysis": analysis,
                 "cached": False,
             }
-            with STORE_LOCK:
-                ANALYSIS_CACHE[file_hash] = payload
-            _set_job(job_id, status="completed", completed_at=_now_iso(), result=payload)
+            # Only cache analyses built from the full text; skipped_pages carries
+            # the truncation to the client, same as /analyze
+            if not skipped_pages:
+                await run_in_threadpool(
+                    _store_analysis, file_hash, payload, fingerprint_vec, len(full_text)
+                )
+            await _set_job(job_id, status="completed", completed_at=_now_iso(), result=payload)
         except RateLimitExceeded as e:
             fallback = {
                 "filename": filename,
                 "total_pages": len(pages),
-                "total_tokens": count_tokens(full_text),
+                "total_tokens": tokens,
+                "skipped_pages": skipped_pages,
                 "analysis": _build_fallback_analysis(
                     sections,
                     "Gemini rate limit reached. Showing extracted structure now; "
@@ -120,7 +375,7 @@ def _run_analysis_job(job_id: str, filename: str, file_bytes: bytes, file_hash:
                 ),
                 "cached": False,
             }
-            _set_job(
+            await _set_job(
                 job_id,
                 status="partial",
                 completed_at=_now_iso(),
@@ -128,7 +383,12 @@ def _run_analysis_job(job_id: str, filename: str, file_bytes: bytes, file_hash:
                 result=fallback,
             )
     except Exception as e:
-        _set_job(job_id, status="failed", completed_at=_now_iso(), error=str(e))
+        await _set_job(job_id, status="failed", completed_at=_now_iso(), error=str(e))
+    finally:
+        spool.close()
+
+# Added before CORS so CORS headers still wrap its 413 responses
+app.add_middleware(MaxBodySizeMiddleware, max_bytes=MAX_REQUEST_BYTES)
 
 # CORS — allow frontend to talk to backend
 app.add_middleware(
@@ -142,7 +402,10 @@ app.add_middleware(
 
 @app.get("/")
 def root():
-    return {"status": "online", "service": "Stark Paper Analyzer v0.1"}
+    with STORE_LOCK:
+        cache_stats = {**CACHE_STATS, "entries": len(ANALYSIS_CACHE)}
+    cache_stats["disk_entries"] = len(DISK_CACHE)
+    return {"status": "online", "service": "Stark Paper Analyzer v0.1", "cache": cache_stats}
 
 
 @app.post("/upload")
@@ -155,15 +418,19 @@ async def upload_pdf(file: UploadFile = File(...)):
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are accepted.")
 
-    file_bytes = await file.read()
+    spool, _ = await _spool_upload(file)
 
     try:
-        pages = extract_text_by_pages(file_bytes)
+        pages = await run_in_threadpool(extract_text_by_pages, spool.read())
+    except PDFTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Failed to parse PDF: {str(e)}")
+    finally:
+        spool.close()
 
     full_text = "\n\n".join(p["text"] for p in pages if p["text"])
-    sections = detect_sections(pages)
+    sections = await run_in_threadpool(detect_sections, pages, full_text)
     tokens = count_tokens(full_text)
 
     return {
@@ -171,6 +438,7 @@ async def upload_pdf(file: UploadFile = File(...)):
         "total_pages": len(pages),
         "total_characters": len(full_text),
         "total_tokens": tokens,
+        "skipped_pages": skipped_page_numbers(pages),
         "detected_sections": [
             {
                 "name": s["name"],
@@ -191,13 +459,22 @@ async def analyze_pdf(file: UploadFile = File(...)):
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are accepted.")
 
-    file_bytes = await file.read()
-    file_hash = hashlib.sha256(file_bytes).hexdigest()
+    spool, file_hash = await _spool_upload(file)
 
     try:
-        pages = extract_text_by_pages(file_bytes)
-    except Exception as e:
-        raise HTTPException(status_code=422, detail=f"Failed to parse PDF: {str(e)}")
+        # Check the cache before parsing so repeat uploads skip extraction entirely
+        cached_payload = await run_in_threadpool(_get_cached_analysis, file_hash)
+        if cached_payload:
+            return {**cached_payload, "cached": True}
+
+        try:
+            pages = await run_in_threadpool(extract_text_by_pages, spool.read())
+        except PDFTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Failed to parse PDF: {str(e)}")
+    finally:
+        spool.close()
 
     full_text = "\n\n".join(p["text"] for p in pages if p["text"])
 
@@ -207,15 +484,19 @@ async def analyze_pdf(file: UploadFile = File(...)):
             detail="PDF contains no extractable text. It may be scanned/image-based.",
         )
 
-    with STORE_LOCK:
-        cached_payload = ANALYSIS_CACHE.get(file_hash)
+    # Exact hash missed; a re-export of an already analyzed paper may still match
+    fingerprint_vec = await run_in_threadpool(embed, full_text)
+    cached_payload = await run_in_threadpool(
+        _get_similar_cached, file_hash, fingerprint_vec, file.filename, pages, full_text
+    )
     if cached_payload:
         return {**cached_payload, "cached": True}
 
-    sections = detect_sections(pages)
+    sections = await run_in_threadpool(detect_sections, pages, full_text)
+    tokens = count_tokens(full_text)
 
     try:
-        result = process_paper(sections)
+        result = await process_paper(sections)
     except RateLimitExceeded as e:
         raise HTTPException(
             status_code=429,
@@ -231,16 +512,21 @@ async def analyze_pdf(file: UploadFile = File(...)):
             detail=f"Summarization failed: {str(e)}",
         )
 
+    skipped_pages = skipped_page_numbers(pages)
     payload = {
         "filename": file.filename,
         "total_pages": len(pages),
-        "total_tokens": count_tokens(full_text),
+        "total_tokens": tokens,
+        "skipped_pages": skipped_pages,
         "analysis": result,
         "cached": False,
     }
 
-    with STORE_LOCK:
-        ANALYSIS_CACHE[file_hash] = payload
+    # Only cache analyses built from the full text
+    if not skipped_pages:
+        await run_in_threadpool(
+            _store_analysis, file_hash, payload, fingerprint_vec, len(full_text)
+        )
 
     return payload
 
@@ -254,12 +540,14 @@ async def create_analysis_job(background_tasks: BackgroundTasks, file: UploadFil
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are accepted.")
 
-    file_bytes = await file.read()
-    file_hash = hashlib.sha256(file_bytes).hexdigest()
+    # The job owns the spool from here on and closes it when it finishes
+    spool, file_hash = await _spool_upload(file)
     job_id = str(uuid.uuid4())
 
-    with STORE_LOCK:
-        JOBS[job_id] = {
+    await run_in_threadpool(
+        JOBS.set,
+        job_id,
+        {
             "job_id": job_id,
             "filename": file.filename,
             "status": "queued",
@@ -268,9 +556,11 @@ async def create_analysis_job(background_tasks: BackgroundTasks, file: UploadFil
             "completed_at": None,
             "error": None,
             "result": None,
-        }
+        },
+        expire=JOB_TTL_SECONDS,
+    )
 
-    background_tasks.add_task(_run_analysis_job, job_id, file.filename, file_bytes, file_hash)
+    background_tasks.add_task(_run_analysis_job, job_id, file.filename, spool, file_hash)
 
     return {
         "job_id": job_id,
@@ -282,8 +572,7 @@ async def create_analysis_job(background_tasks: BackgroundTasks, file: UploadFil
 
 @app.get("/jobs/{job_id}")
 def get_job_status(job_id: str):
-    with STORE_LOCK:
-        job = JOBS.get(job_id)
+    job = JOBS.get(job_id)
 
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
@@ -301,8 +590,7 @@ def get_job_status(job_id: str):
 
 @app.get("/jobs/{job_id}/result")
 def get_job_result(job_id: str):
-    with STORE_LOCK:
-        job = JOBS.get(job_id)
+    job = JOBS.get(job_id)
 
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
@@ -314,3 +602,17 @@ def get_job_result(job_id: str):
         raise HTTPException(status_code=500, detail=job["error"] or "Job failed")
 
     return job["result"]
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # One worker per core; "auto" picks uvloop/httptools when installed
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WORKERS", os.cpu_count() or 1)),
+        loop="auto",
+        http="auto",
+    )
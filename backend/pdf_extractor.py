@@ -1,48 +1,108 @@
 """
-PDF text and image extraction using pdfplumber.
+PDF text and image extraction using PyMuPDF.
 Extracts text page-by-page, preserving structure where possible.
 """
 
+import bisect
+import logging
 import pdfplumber
+import pymupdf
 import re
+import time
 from io import BytesIO
 
+# pdfminer (used by pdfplumber for table extraction) logs per token at DEBUG,
+# which can dominate runtime when the root logger is verbose
+logging.getLogger("pdfminer").setLevel(logging.ERROR)
+logging.getLogger("pdfplumber").setLevel(logging.ERROR)
+
+MAX_PAGES = 500
+EXTRACT_TIME_BUDGET_SECONDS = 60  # Total text extraction time per document, not per page
+
+
+class PDFTooLarge(Exception):
+    """Raised when a PDF exceeds the page-count limit."""
+
+
+# Common research paper section patterns
+_SECTION_RE = re.compile(
+    r"^(?:\d+\.?\s*)?(?:abstract|introduction|background|related\s*work|"
+    r"literature\s*review|methodology|methods?|approach|proposed\s*(?:method|approach|system)|"
+    r"experiment(?:s|al)?(?:\s*(?:setup|results?))?|results?(?:\s*and\s*discussion)?|"
+    r"discussion|analysis|evaluation|conclusion(?:s)?|future\s*work|"
+    r"acknowledg(?:e)?ments?|references|bibliography|appendix)",
+    re.IGNORECASE,
+)
+
+# Numbered sections like "1. Introduction" or "2 Methods"
+_NUMBERED_RE = re.compile(r"^\d+\.?\s+[A-Z]")
+
 
 def extract_text_by_pages(file_bytes: bytes) -> list[dict]:
-    """Extract text from each page of the PDF."""
+    """
+    Extract text from each page of the PDF.
+    Once extraction of the document has taken EXTRACT_TIME_BUDGET_SECONDS in
+    total, the remaining pages are left empty and flagged with "skipped": True.
+    This bounds the total time only; a page already being extracted is not interrupted.
+    """
     pages = []
-    with pdfplumber.open(BytesIO(file_bytes)) as pdf:
-        for i, page in enumerate(pdf.pages):
-            text = page.extract_text() or ""
-            tables = page.extract_tables() or []
+    doc = pymupdf.open(stream=file_bytes, filetype="pdf")
+    try:
+        if doc.page_count > MAX_PAGES:
+            raise PDFTooLarge(
+                f"PDF has {doc.page_count} pages; the limit is {MAX_PAGES}."
+            )
+
+        deadline = time.monotonic() + EXTRACT_TIME_BUDGET_SECONDS
+        for i, page in enumerate(doc):
+            skipped = time.monotonic() >= deadline
+            text = "" if skipped else page.get_text("text") or ""
             pages.append({
                 "page_number": i + 1,
                 "text": text.strip(),
-                "tables": tables,
+                "tables": [],  # Tables are not used downstream; skip extracting them
+                "skipped": skipped,
             })
+    finally:
+        doc.close()
     return pages
 
 
-def detect_sections(pages: list[dict]) -> list[dict]:
+def skipped_page_numbers(pages: list[dict]) -> list[int]:
+    """Page numbers whose text was not extracted because the time budget ran out."""
+    return [p["page_number"] for p in pages if p.get("skipped")]
+
+
+def extract_tables_by_pages(file_bytes: bytes, pages_wanted: list[int]) -> dict[int, list]:
+    """
+    Extract tables only from the requested (1-based) page numbers.
+    Table extraction is expensive, so it is kept out of the upload path
+    and should only be called when a caller actually needs tables.
+    """
+    tables_by_page = {}
+    with pdfplumber.open(BytesIO(file_bytes)) as pdf:
+        for page_number in sorted(set(pages_wanted)):
+            if not 1 <= page_number <= len(pdf.pages):
+                continue
+            tables_by_page[page_number] = pdf.pages[page_number - 1].extract_tables() or []
+    return tables_by_page
+
+
+def detect_sections(pages: list[dict], full_text: str | None = None) -> list[dict]:
     """
     Attempt to detect section headings from the extracted text.
     Uses heuristics: lines that are short, uppercase, or match common patterns.
+    Pass `full_text` if the caller already joined the pages, to avoid rebuilding it.
     """
-    full_text = "\n\n".join(p["text"] for p in pages if p["text"])
+    if full_text is None:
+        full_text = "\n\n".join(p["text"] for p in pages if p["text"])
     lines = full_text.split("\n")
 
-    # Common research paper section patterns
-    section_patterns = [
-        r"^(?:\d+\.?\s*)?(?:abstract|introduction|background|related\s*work|"
-        r"literature\s*review|methodology|methods?|approach|proposed\s*(?:method|approach|system)|"
-        r"experiment(?:s|al)?(?:\s*(?:setup|results?))?|results?(?:\s*and\s*discussion)?|"
-        r"discussion|analysis|evaluation|conclusion(?:s)?|future\s*work|"
-        r"acknowledg(?:e)?ments?|references|bibliography|appendix)",
-    ]
-    combined_pattern = "|".join(section_patterns)
-
     sections = []
     current_section = {"name": "Preamble", "content": "", "page_start": 1}
+    # Collect lines in a list and join on save; repeated += is quadratic on big sections
+    content_lines = []
+    has_content = False
 
     page_char_offsets = []
     offset = 0
@@ -51,44 +111,41 @@ def detect_sections(pages: list[dict]) -> list[dict]:
         offset += len(p["text"]) + 2  # +2 for \n\n
 
     def find_page_for_offset(char_offset):
-        for i in range(len(page_char_offsets) - 1, -1, -1):
-            if char_offset >= page_char_offsets[i]:
-                return i + 1
-        return 1
+        # Offsets are increasing, so the count of page starts <= offset is the page number
+        return bisect.bisect_right(page_char_offsets, char_offset)
 
     char_offset = 0
     for line in lines:
         stripped = line.strip()
-        is_heading = False
-
-        # Check if line matches section patterns (case-insensitive)
-        if stripped and re.match(combined_pattern, stripped.lower()):
-            is_heading = True
-
-        # Also detect numbered sections like "1. Introduction" or "2 Methods"
-        if not is_heading and re.match(r"^\d+\.?\s+[A-Z]", stripped) and len(stripped) < 80:
-            is_heading = True
 
-        # All-caps short lines are likely headings
-        if not is_heading and stripped.isupper() and 3 < len(stripped) < 60:
-            is_heading = True
+        # Known section names, numbered headings, or short all-caps lines
+        is_heading = bool(stripped) and bool(
+            _SECTION_RE.match(stripped)
+            or (_NUMBERED_RE.match(stripped) and len(stripped) < 80)
+            or (stripped.isupper() and 3 < len(stripped) < 60)
+        )
 
-        if is_heading and stripped:
+        if is_heading:
             # Save previous section
-            if current_section["content"].strip():
-                sections.append(current_section.copy())
+            if has_content:
+                current_section["content"] = "\n".join(content_lines) + "\n"
+                sections.append(current_section)
             current_section = {
                 "name": stripped,
                 "content": "",
                 "page_start": find_page_for_offset(char_offset),
             }
+            content_lines = []
+            has_content = False
         else:
-            current_section["content"] += line + "\n"
+            content_lines.append(line)
+            has_content = has_content or bool(stripped)
 
         char_offset += len(line) + 1
 
     # Don't forget the last section
-    if current_section["content"].strip():
+    if has_content:
+        current_section["content"] = "\n".join(content_lines) + "\n"
         sections.append(current_section)
 
     # If no sections detected, return the whole text as one section
@@ -0,0 +1,143 @@
+"""
+Near-duplicate lookup for previously analyzed papers.
+Embeds a normalized fingerprint of the paper text and searches a FAISS
+inner-product index, so a re-export of the same paper reuses its analysis.
+The index lives in process memory and is not persisted: each worker starts
+empty and only knows the papers it has analyzed itself.
+Optional: disabled when sentence-transformers or faiss are not installed.
+"""
+
+import math
+import re
+from threading import Lock
+
+try:
+    import faiss
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    faiss = None
+    np = None
+    SentenceTransformer = None
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+FINGERPRINT_CHARS = 8 * 1024
+# The model truncates input at 256 word pieces (~1 KB of text), so the
+# fingerprint is embedded in windows small enough to be seen in full
+WINDOW_CHARS = 512
+NUM_WINDOWS = FINGERPRINT_CHARS // WINDOW_CHARS
+INDEX_DIM = EMBEDDING_DIM * NUM_WINDOWS
+SIMILARITY_THRESHOLD = 0.95  # Mean cosine similarity across windows
+MIN_LENGTH_RATIO = 0.95  # Text lengths of two matching papers must be this close
+MAX_INDEX_ENTRIES = 1024
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+_model = None
+_model_failed = False
+_model_lock = Lock()
+
+
+def is_enabled() -> bool:
+    return faiss is not None and not _model_failed
+
+
+def _get_model():
+    """Lazy-load the embedding model (ONNX on CPU) on first use."""
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = SentenceTransformer(MODEL_NAME, backend="onnx", device="cpu")
+    return _model
+
+
+def fingerprint(text: str) -> str:
+    """Lowercase, collapse whitespace and keep the first FINGERPRINT_CHARS characters."""
+    # Normalize a bounded prefix only; collapsing whitespace can only shrink it
+    head = text[: FINGERPRINT_CHARS * 4]
+    return _WHITESPACE_RE.sub(" ", head.lower()).strip()[:FINGERPRINT_CHARS]
+
+
+def embed(text: str):
+    """
+    Return a (1, INDEX_DIM) float32 vector, or None if the layer is disabled.
+    Each window is embedded separately and the unit vectors are concatenated
+    (zero-padded) and rescaled, so the inner product of two fingerprints is
+    the mean cosine similarity of their aligned windows.
+    """
+    global _model_failed
+    if not is_enabled():
+        return None
+
+    normalized = fingerprint(text)
+    windows = [
+        normalized[i:i + WINDOW_CHARS]
+        for i in range(0, len(normalized), WINDOW_CHARS)
+    ] or [""]
+
+    try:
+        window_vecs = _get_model().encode(
+            windows,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        )
+    except Exception as e:
+        print(f"Semantic cache disabled: failed to load or run embedding model ({e})")
+        _model_failed = True
+        return None
+
+    vec = np.zeros((1, INDEX_DIM), dtype="float32")
+    vec[0, : window_vecs.size] = window_vecs.reshape(-1) / math.sqrt(len(windows))
+    return vec
+
+
+class SemanticIndex:
+    """
+    Maps fingerprint embeddings to analysis cache keys.
+    Only stores keys; payloads stay in the analysis cache so its TTL still applies.
+    Not thread-safe by itself; callers hold STORE_LOCK.
+    """
+
+    def __init__(
+        self,
+        threshold: float = SIMILARITY_THRESHOLD,
+        max_entries: int = MAX_INDEX_ENTRIES,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._index = faiss.IndexFlatIP(INDEX_DIM) if faiss is not None else None
+        # (cache key, page count, text length) per stored vector
+        self._entries: list[tuple[str, int, int]] = []
+
+    def search(self, vec, total_pages: int, text_length: int) -> str | None:
+        """
+        Return the cache key of the closest stored paper if it clears the
+        similarity threshold and has the same page count and a similar text length.
+        """
+        if self._index is None or vec is None or self._index.ntotal == 0:
+            return None
+
+        scores, ids = self._index.search(vec, 1)
+        best_id = int(ids[0][0])
+        if best_id < 0 or scores[0][0] < self.threshold:
+            return None
+
+        key, stored_pages, stored_length = self._entries[best_id]
+        if stored_pages != total_pages:
+            return None
+        if min(stored_length, text_length) < MIN_LENGTH_RATIO * max(stored_length, text_length):
+            return None
+        return key
+
+    def add(self, vec, key: str, total_pages: int, text_length: int):
+        if self._index is None or vec is None:
+            return
+
+        # IndexFlatIP has no cheap eviction; start over once it is full
+        if self._index.ntotal >= self.max_entries:
+            self._index.reset()
+            self._entries.clear()
+
+        self._index.add(vec)
+        self._entries.append((key, total_pages, text_length))
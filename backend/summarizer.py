@@ -4,9 +4,11 @@ Chunks text intelligently, summarizes each chunk, then synthesizes a global summ
 """
 
 import os
-import json
-import time
+import asyncio
+import hashlib
+import orjson
 from google import genai
+from google.genai import errors
 from dotenv import load_dotenv
 
 _THIS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -14,6 +16,8 @@ load_dotenv(os.path.join(_THIS_DIR, ".env"))
 
 MAX_CHUNK_CHARS = 12000  # ~3000 tokens worth of characters
 MODEL = "gemini-2.5-flash"  # Free tier, fast, handles JSON well
+MAX_CONCURRENT_CALLS = 4  # Cap on Gemini requests in flight at once, not a requests/minute limit
+MAX_BATCH_CHARS = 80000  # Chunk text sent per batched section-summary request
 
 _client = None
 
@@ -60,34 +64,52 @@ def chunk_by_sections(sections: list[dict], max_chars: int = MAX_CHUNK_CHARS) ->
             })
         else:
             # Split large section into sub-chunks by paragraphs
+            # Collect paragraphs in a list and track the joined length, rather
+            # than growing one string (quadratic on large sections)
             paragraphs = content.split("\n\n")
-            current_chunk = ""
+            current_parts = [""]
+            current_len = 0
             chunk_index = 1
 
             for para in paragraphs:
-                if len(current_chunk) + len(para) + 2 > max_chars:
-                    if current_chunk.strip():
+                if current_len + len(para) + 2 > max_chars:
+                    current_chunk = "\n\n".join(current_parts).strip()
+                    if current_chunk:
                         chunks.append({
                             "name": f"{name} (Part {chunk_index})",
-                            "content": current_chunk.strip(),
+                            "content": current_chunk,
                             "page_start": section.get("page_start", 0),
                         })
                         chunk_index += 1
-                    current_chunk = para
+                    current_parts = [para]
+                    current_len = len(para)
                 else:
-                    current_chunk += "\n\n" + para
+                    current_parts.append(para)
+                    current_len += len(para) + 2
 
-            if current_chunk.strip():
+            current_chunk = "\n\n".join(current_parts).strip()
+            if current_chunk:
                 chunks.append({
                     "name": f"{name} (Part {chunk_index})" if chunk_index > 1 else name,
-                    "content": current_chunk.strip(),
+                    "content": current_chunk,
                     "page_start": section.get("page_start", 0),
                 })
 
     return chunks
 
 
-def _call_gemini(prompt: str) -> dict:
+def _is_rate_limit_error(e: Exception) -> bool:
+    """Check the typed API error for a quota hit; only sniff the message if it has no code."""
+    if isinstance(e, errors.APIError):
+        if e.code == 429 or getattr(e, "status", None) == "RESOURCE_EXHAUSTED":
+            return True
+        if e.code is not None:
+            return False
+    message = str(e)
+    return "RESOURCE_EXHAUSTED" in message or "quota" in message.lower()
+
+
+async def _call_gemini(prompt: str) -> dict | list:
     """Call Gemini and parse JSON response with retry logic for quota limits."""
     client = get_client()
     max_retries = 3
@@ -95,7 +117,7 @@ def _call_gemini(prompt: str) -> dict:
     
     for attempt in range(max_retries):
         try:
-            response = client.models.generate_content(
+            response = await client.aio.models.generate_content(
                 model=MODEL,
                 contents=prompt,
                 config={
@@ -103,13 +125,13 @@ def _call_gemini(prompt: str) -> dict:
                     "response_mime_type": "application/json",
                 },
             )
-            return json.loads(response.text)
+            return orjson.loads(response.text)
         except Exception as e:
-            if "RESOURCE_EXHAUSTED" in str(e) or "quota" in str(e).lower():
+            if _is_rate_limit_error(e):
                 if attempt < max_retries - 1:
                     delay = base_delay * (2 ** attempt)  # Exponential backoff
                     print(f"Rate limited. Retrying in {delay} seconds... (attempt {attempt + 1}/{max_retries})")
-                    time.sleep(delay)
+                    await asyncio.sleep(delay)
                     continue
                 else:
                     raise RateLimitExceeded(
@@ -120,7 +142,7 @@ def _call_gemini(prompt: str) -> dict:
                 raise  # Re-raise non-quota errors immediately
 
 
-def summarize_chunk(chunk: dict) -> dict:
+async def summarize_chunk(chunk: dict) -> dict:
     """Summarize a single chunk using Gemini."""
     prompt = f"""You are a research paper analysis assistant.
 
@@ -143,8 +165,12 @@ Respond in this exact JSON format:
   "key_terms": ["term1", "term2", ...]
 }}"""
 
-    result = _call_gemini(prompt)
+    result = await _call_gemini(prompt)
+
+    return _section_from_result(chunk, result)
+
 
+def _section_from_result(chunk: dict, result: dict) -> dict:
     return {
         "section_name": chunk["name"],
         "page_start": chunk.get("page_start", 0),
@@ -154,92 +180,323 @@ Respond in this exact JSON format:
     }
 
 
-def generate_global_summary(section_summaries: list[dict]) -> dict:
-    """Combine section summaries into a global paper summary."""
-    combined = "\n\n".join(
-        f"**{s['section_name']}**: {s['summary']}"
-        for s in section_summaries
+def _section_error(chunk: dict, message: str) -> dict:
+    return {
+        "section_name": chunk["name"],
+        "page_start": chunk.get("page_start", 0),
+        "summary": f"Error summarizing: {message}",
+        "key_points": [],
+        "key_terms": [],
+    }
+
+
+def group_chunks(chunks: list[dict], max_chars: int = MAX_BATCH_CHARS) -> list[list[dict]]:
+    """Group consecutive chunks so each group's total text stays within max_chars."""
+    groups = []
+    current_group = []
+    current_chars = 0
+
+    for chunk in chunks:
+        chunk_chars = len(chunk["content"])
+        if current_group and current_chars + chunk_chars > max_chars:
+            groups.append(current_group)
+            current_group = []
+            current_chars = 0
+        current_group.append(chunk)
+        current_chars += chunk_chars
+
+    if current_group:
+        groups.append(current_group)
+
+    return groups
+
+
+def _match_batch_results(results: list, count: int) -> list[dict | None]:
+    """
+    Line up a batched JSON array with the `count` sections that were sent.
+    Trust section_index only if the indices are exactly 1..count; otherwise
+    fall back to array position when the lengths match. None marks a section
+    that could not be matched.
+    """
+    indices = [r.get("section_index") if isinstance(r, dict) else None for r in results]
+    valid_ints = all(type(i) is int for i in indices)
+    if valid_ints and sorted(indices) == list(range(1, count + 1)):
+        by_index = dict(zip(indices, results))
+        return [by_index[i] for i in range(1, count + 1)]
+
+    if len(results) == count:
+        return [r if isinstance(r, dict) else None for r in results]
+
+    return [None] * count
+
+
+async def summarize_chunks_batch(chunks: list[dict]) -> list[dict]:
+    """
+    Summarize several chunks with a single Gemini request.
+    Returns one summary per chunk, in the same order as `chunks`.
+    """
+    if len(chunks) == 1:
+        return [await summarize_chunk(chunks[0])]
+
+    sections_text = "\n\n".join(
+        f"[[SECTION {i}: {chunk['name']}]]\n{chunk['content']}"
+        for i, chunk in enumerate(chunks, start=1)
     )
 
     prompt = f"""You are a research paper analysis assistant.
 
-Below are summaries of each section of a research paper:
+Summarize each of the following {len(chunks)} sections from a research paper.
+Each section starts with a [[SECTION n: name]] marker.
 
-{combined}
+{sections_text}
 
-Based on these section summaries, provide a comprehensive analysis:
+For each section provide:
+1. A 2-3 sentence summary
+2. 3-5 key points as bullet points
+3. Any important terms or concepts mentioned
 
-1. Paper title (infer from content)
+Respond with a JSON array of exactly {len(chunks)} objects, one per section, in order, in this exact format:
+[
+  {{
+    "section_index": 1,
+    "summary": "...",
+    "key_points": ["point1", "point2", ...],
+    "key_terms": ["term1", "term2", ...]
+  }},
+  ...
+]"""
+
+    results = await _call_gemini(prompt)
+    if not isinstance(results, list):
+        raise ValueError("Expected a JSON array of section summaries")
+
+    matched = _match_batch_results(results, len(chunks))
+    return [
+        _section_from_result(chunk, result)
+        if result is not None
+        else _section_error(chunk, "missing from batched response")
+        for chunk, result in zip(chunks, matched)
+    ]
+
+
+_GLOBAL_INSTRUCTIONS = """1. Paper title (infer from content)
 2. A 5-line overall summary of the entire paper
 3. Problem statement (what problem does this paper solve?)
 4. Methodology overview (how do they solve it?)
 5. Key results and contributions (3-5 bullet points)
 6. Limitations mentioned or implied
 7. 3 possible future research directions / open gaps
-8. A list of all key terms across the paper
+8. A list of all key terms across the paper"""
 
-Respond in this exact JSON format:
-{{
-  "inferred_title": "...",
+_GLOBAL_JSON_FIELDS = """  "inferred_title": "...",
   "global_summary": "...",
   "problem_statement": "...",
   "methodology": "...",
   "key_contributions": ["...", "..."],
   "limitations": ["...", "..."],
   "future_work": ["...", "..."],
-  "all_key_terms": ["...", "..."]
+  "all_key_terms": ["...", "..."]"""
+
+
+def _global_error(message: str) -> dict:
+    return {
+        "inferred_title": "Unknown",
+        "global_summary": f"Error generating global summary: {message}",
+        "problem_statement": "",
+        "methodology": "",
+        "key_contributions": [],
+        "limitations": [],
+        "future_work": [],
+        "all_key_terms": [],
+    }
+
+
+async def generate_global_summary(section_summaries: list[dict]) -> dict:
+    """Combine section summaries into a global paper summary."""
+    combined = "\n\n".join(
+        f"**{s['section_name']}**: {s['summary']}"
+        for s in section_summaries
+    )
+
+    prompt = f"""You are a research paper analysis assistant.
+
+Below are summaries of each section of a research paper:
+
+{combined}
+
+Based on these section summaries, provide a comprehensive analysis:
+
+{_GLOBAL_INSTRUCTIONS}
+
+Respond in this exact JSON format:
+{{
+{_GLOBAL_JSON_FIELDS}
 }}"""
 
-    return _call_gemini(prompt)
+    return await _call_gemini(prompt)
 
 
-def process_paper(sections: list[dict]) -> dict:
+async def analyze_short_paper(sections: list[dict]) -> tuple[dict, list[dict]]:
     """
-    Full pipeline: sections → chunks → section summaries → global summary.
-    Returns the complete structured analysis.
+    Analyze a paper small enough for one request: the global analysis and
+    a summary of every section come back from a single Gemini call.
+    Returns (global_analysis, section_summaries).
+    """
+    sections_text = "\n\n".join(
+        f"[[SECTION {i}: {section['name']}]]\n{section['content']}"
+        for i, section in enumerate(sections, start=1)
+    )
+
+    prompt = f"""You are a research paper analysis assistant.
+
+Below is the full text of a research paper, split into {len(sections)} sections.
+Each section starts with a [[SECTION n: name]] marker.
+
+{sections_text}
+
+Based on this text, provide a comprehensive analysis:
+
+{_GLOBAL_INSTRUCTIONS}
+9. For each section: a 2-3 sentence summary, 3-5 key points, and important terms
+
+Respond in this exact JSON format, with exactly {len(sections)} entries in "sections", in order:
+{{
+{_GLOBAL_JSON_FIELDS},
+  "sections": [
+    {{
+      "section_index": 1,
+      "summary": "...",
+      "key_points": ["point1", "point2", ...],
+      "key_terms": ["term1", "term2", ...]
+    }},
+    ...
+  ]
+}}"""
+
+    result = await _call_gemini(prompt)
+    if not isinstance(result, dict):
+        raise ValueError("Expected a JSON object with the paper analysis")
+
+    section_results = result.pop("sections", None)
+    if not isinstance(section_results, list):
+        section_results = []
+
+    matched = _match_batch_results(section_results, len(sections))
+    section_summaries = [
+        _section_from_result(section, section_result)
+        if section_result is not None
+        else _section_error(section, "missing from single-pass response")
+        for section, section_result in zip(sections, matched)
+    ]
+    return result, section_summaries
+
+
+async def _summarize_sections(sections: list[dict]) -> tuple[list[dict], dict]:
+    """
+    Chunk sections, summarize unique chunks in concurrent batched requests,
+    and fan the summaries back out to every chunk.
+    Returns (section_summaries, stats).
     """
     # Step 1: Chunk sections to fit token limits
     chunks = chunk_by_sections(sections)
 
-    # Step 2: Summarize each chunk
-    section_summaries = []
-    for chunk in chunks:
+    # Repeated boilerplate can yield identical chunks; summarize each once
+    chunk_keys = [
+        hashlib.blake2b(chunk["content"].encode(), digest_size=16).digest()
+        for chunk in chunks
+    ]
+    unique_chunks = {}
+    for key, chunk in zip(chunk_keys, chunks):
+        unique_chunks.setdefault(key, chunk)
+
+    # Step 2: Summarize chunks in batched requests, run concurrently but
+    # bounded to respect the rate limit
+    groups = group_chunks(list(unique_chunks.values()))
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
+
+    async def _sem_call(group: list[dict]) -> list[dict]:
+        async with semaphore:
+            return await summarize_chunks_batch(group)
+
+    tasks = [asyncio.create_task(_sem_call(group)) for group in groups]
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+            # Quota is exhausted for everyone; don't let the other batches keep retrying
+            for task in done:
+                if isinstance(task.exception(), RateLimitExceeded):
+                    raise task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    results = [task.exception() or task.result() for task in tasks]
+
+    unique_summaries = []
+    for group, result in zip(groups, results):
+        if isinstance(result, Exception):
+            unique_summaries.extend(_section_error(chunk, str(result)) for chunk in group)
+        else:
+            unique_summaries.extend(result)
+
+    # Groups preserve chunk order, so summaries line up with unique_chunks
+    results_by_key = dict(zip(unique_chunks, unique_summaries))
+    section_summaries = [
+        {
+            **results_by_key[key],
+            "section_name": chunk["name"],
+            "page_start": chunk.get("page_start", 0),
+        }
+        for key, chunk in zip(chunk_keys, chunks)
+    ]
+
+    stats = {
+        "total_chunks_processed": len(chunks),
+        "total_unique_chunks": len(unique_chunks),
+        "total_batches": len(groups),
+        "mode": "sectioned",
+    }
+    return section_summaries, stats
+
+
+async def process_paper(sections: list[dict]) -> dict:
+    """
+    Full pipeline: sections → chunks → section summaries → global summary.
+    Papers that fit in a single chunk are analyzed with one request instead.
+    Returns the complete structured analysis.
+    """
+    # Short papers fit in one request, so separate section passes would be wasted calls
+    if sum(len(s["content"]) for s in sections) <= MAX_CHUNK_CHARS:
         try:
-            summary = summarize_chunk(chunk)
-            section_summaries.append(summary)
+            global_analysis, section_summaries = await analyze_short_paper(sections)
         except RateLimitExceeded:
             raise
         except Exception as e:
-            section_summaries.append({
-                "section_name": chunk["name"],
-                "page_start": chunk.get("page_start", 0),
-                "summary": f"Error summarizing: {str(e)}",
-                "key_points": [],
-                "key_terms": [],
-            })
-
-    # Step 3: Generate global summary from section summaries
-    try:
-        global_analysis = generate_global_summary(section_summaries)
-    except RateLimitExceeded:
-        raise
-    except Exception as e:
-        global_analysis = {
-            "inferred_title": "Unknown",
-            "global_summary": f"Error generating global summary: {str(e)}",
-            "problem_statement": "",
-            "methodology": "",
-            "key_contributions": [],
-            "limitations": [],
-            "future_work": [],
-            "all_key_terms": [],
+            global_analysis = _global_error(str(e))
+            section_summaries = [_section_error(section, str(e)) for section in sections]
+
+        stats = {
+            "total_chunks_processed": len(sections),
+            "total_unique_chunks": len(sections),
+            "total_batches": 1,
+            "mode": "single_pass",
         }
+    else:
+        section_summaries, stats = await _summarize_sections(sections)
+
+        # Step 3: Generate global summary from section summaries
+        try:
+            global_analysis = await generate_global_summary(section_summaries)
+        except RateLimitExceeded:
+            raise
+        except Exception as e:
+            global_analysis = _global_error(str(e))
 
     return {
         "global": global_analysis,
         "sections": section_summaries,
-        "stats": {
-            "total_sections": len(sections),
-            "total_chunks_processed": len(chunks),
-        },
+        "stats": {"total_sections": len(sections), **stats},
     }